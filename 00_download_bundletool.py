@@ -2,9 +2,36 @@
 import requests
 import os
 import sys
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+TAG_FILE = './bundletool.tag'
+ETAG_FILE = './bundletool.etag'
+CHUNK_SIZE = 1024 * 1024
+
+def read_sidecar(path):
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            return f.read().strip()
+    return None
+
+def write_sidecar(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+def create_session():
+    # One session for both requests, so the connection is kept alive between
+    # them, with retries on transient server errors
+    session = requests.Session()
+    session.headers['User-Agent'] = 'bundletool-fetcher'
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=2, max_retries=retry)
+    session.mount('https://', adapter)
+    return session
 
 def create_wrapper_script(jar_path):
     wrapper_content = f'''#!/bin/sh
+#jar={jar_path}
 exec java -jar "{jar_path}" "$@"
 '''
     wrapper_path = './bundletool'
@@ -16,10 +43,11 @@ exec java -jar "{jar_path}" "$@"
 def download_latest_bundletool():
     # GitHub API endpoint for latest release
     api_url = "https://api.github.com/repos/google/bundletool/releases/latest"
+    session = create_session()
     
     try:
         # Get the latest release information
-        response = requests.get(api_url)
+        response = session.get(api_url)
         response.raise_for_status()
         release_data = response.json()
         
@@ -31,22 +59,49 @@ def download_latest_bundletool():
         download_url = jar_asset['browser_download_url']
         jar_name = jar_asset['name']
         
-        # Download the JAR file
-        print(f"Downloading bundletool from: {download_url}")
-        response = requests.get(download_url)
-        response.raise_for_status()
-        
-        # Save the JAR with its original name
         jar_path = os.path.abspath(f'./{jar_name}')
-        with open(jar_path, 'wb') as f:
-            f.write(response.content)
+        tag_name = release_data['tag_name']
+        
+        # Skip the download entirely if we already have this release
+        downloaded = False
+        if os.path.exists(jar_path) and read_sidecar(TAG_FILE) == tag_name:
+            print(f"bundletool {tag_name} already downloaded, skipping download")
+        else:
+            # Download the JAR file, unless the server says our copy is current
+            print(f"Downloading bundletool from: {download_url}")
+            headers = {}
+            etag = read_sidecar(ETAG_FILE)
+            if etag and os.path.exists(jar_path):
+                headers['If-None-Match'] = etag
+            with session.get(download_url, headers=headers, stream=True) as response:
+                response.raise_for_status()
+                
+                if response.status_code == 304:
+                    print("Local bundletool JAR is up to date, reusing it")
+                else:
+                    # Save the JAR with its original name, writing it out in
+                    # chunks instead of holding the whole file in memory. It
+                    # only replaces jar_path once complete, so an interrupted
+                    # download never leaves a truncated JAR behind.
+                    part_path = f'{jar_path}.part'
+                    with open(part_path, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            f.write(chunk)
+                    os.replace(part_path, jar_path)
+                    downloaded = True
+                    if 'ETag' in response.headers:
+                        write_sidecar(ETAG_FILE, response.headers['ETag'])
+            write_sidecar(TAG_FILE, tag_name)
         
         # Create the wrapper script
         wrapper_path = create_wrapper_script(jar_path)
         
-        print(f"Successfully downloaded bundletool JAR to: {jar_path}")
+        if downloaded:
+            print(f"Successfully downloaded bundletool JAR to: {jar_path}")
+        else:
+            print(f"Using existing bundletool JAR at: {jar_path}")
         print(f"Created wrapper script at: {wrapper_path}")
-        print(f"Version: {release_data['tag_name']}")
+        print(f"Version: {tag_name}")
         
     except requests.exceptions.RequestException as e:
         print(f"Error downloading bundletool: {e}", file=sys.stderr)
@@ -54,6 +109,8 @@ def download_latest_bundletool():
     except Exception as e:
         print(f"Unexpected error: {e}", file=sys.stderr)
         sys.exit(1)
+    finally:
+        session.close()
 
 if __name__ == "__main__":
     download_latest_bundletool()
@@ -3,39 +3,79 @@ import shutil
 import subprocess
 import sys
 import os
+import re
+import functools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+CheckResult = namedtuple(
+    'CheckResult',
+    ['name', 'installed', 'version', 'is_link', 'link_target'],
+    defaults=[None, False, None]
+)
+
+# A tool that exists but hangs while reporting its version (e.g. waiting on
+# a daemon socket) shouldn't stall the whole check
+PROBE_TIMEOUT = 5
+
+# The '#jar=' marker line the bundletool wrapper records its JAR path in
+WRAPPER_MARKER_RE = re.compile(r'^#jar=[ \t]*(\S.*)$', re.MULTILINE)
+# Fallback for wrappers written before the marker line was added, or with
+# an empty one
+WRAPPER_JAR_RE = re.compile(r'java -jar "([^"]+)"')
+
+@functools.lru_cache(maxsize=None)
+def probe(cmd):
+    """Run a version query once per process and remember its result.
+    
+    cmd is a tuple so it can be used as the cache key. close_fds=False (and
+    no preexec_fn) lets subprocess use posix_spawn instead of fork+exec when
+    the command is a full path.
+    """
+    return subprocess.run(
+        list(cmd),
+        capture_output=True,
+        text=True,
+        close_fds=False,
+        timeout=PROBE_TIMEOUT
+    )
+
 class DependencyChecker:
     def __init__(self):
         self.results = {}
+        self.paths = {}
         self.all_passed = True
 
+    def find_command(self, command):
+        """Return the full path of a command on PATH, or None."""
+        if command not in self.paths:
+            self.paths[command] = shutil.which(command)
+        return self.paths[command]
+
     def check_command(self, command, args=None):
         """Check if a command exists and is executable."""
-        try:
-            if args is None:
-                args = ['--version']
-            
-            result = subprocess.run(
-                [command] + args,
-                capture_output=True,
-                text=True
-            )
-            version = result.stdout if result.stdout else result.stderr
-            return True, version.strip()
-        except FileNotFoundError:
+        if args is None:
+            args = ['--version']
+        
+        # Don't bother spawning anything for tools that aren't on PATH
+        path = self.find_command(command)
+        if path is None:
             return False, None
+        
+        try:
+            result = probe((path, *args))
+        except subprocess.TimeoutExpired:
+            return True, None
+        version = result.stdout if result.stdout else result.stderr
+        return True, version.strip()
 
     def check_symlink(self, command):
         """Check if a command is a symlink and get its target."""
-        try:
-            which_result = shutil.which(command)
-            if which_result:
-                target = os.path.realpath(which_result)
-                return True, target
-            return False, None
-        except Exception:
-            return False, None
+        path = self.find_command(command)
+        if path:
+            return True, os.path.realpath(path)
+        return False, None
 
     def print_result(self, name, installed, version=None, is_link=False, link_target=None):
         """Print the result of a dependency check."""
@@ -61,20 +101,20 @@ class DependencyChecker:
     def check_python(self):
         version = sys.version.split()[0]
         is_python3 = version.startswith('3')
-        self.print_result('Python 3.x', is_python3, version)
+        return CheckResult('Python 3.x', is_python3, version)
 
     def check_git(self):
         installed, version = self.check_command('git')
-        self.print_result('Git', installed, version)
+        return CheckResult('Git', installed, version)
 
     def check_docker(self):
         installed, version = self.check_command('docker')
-        self.print_result('Docker', installed, version)
+        return CheckResult('Docker', installed, version)
 
     def check_adb(self):
         installed, version = self.check_command('adb', ['version'])
         is_link, link_target = self.check_symlink('adb')
-        self.print_result('ADB', installed, version, is_link, link_target)
+        return CheckResult('ADB', installed, version, is_link, link_target)
 
     def check_bundletool(self):
         """Check if bundletool is available and properly linked."""
@@ -87,40 +127,45 @@ class DependencyChecker:
             # Read the wrapper script to find the JAR path
             with open(wrapper_path, 'r') as f:
                 content = f.read()
-                import re
-                jar_match = re.search(r'java -jar "(.*?)"', content)
-                if jar_match:
-                    jar_path = jar_match.group(1)
-                    if os.path.isfile(jar_path):
-                        jar_found = True
+            jar_match = WRAPPER_MARKER_RE.search(content) or WRAPPER_JAR_RE.search(content)
+            if jar_match:
+                jar_path = jar_match.group(1).strip()
+            if jar_path and os.path.isfile(jar_path):
+                jar_found = True
         
-        if jar_found:
+        java_path = self.find_command('java')
+        if jar_found and java_path:
             # Try to get version using java -jar
             try:
-                result = subprocess.run(
-                    ['java', '-jar', jar_path, 'version'],
-                    capture_output=True,
-                    text=True
-                )
+                result = probe((java_path, '-jar', jar_path, 'version'))
                 version = result.stdout.strip() if result.stdout else None
-                self.print_result('Bundletool', True, version, True, jar_path)
-                return
+                return CheckResult('Bundletool', True, version, True, jar_path)
+            except subprocess.TimeoutExpired:
+                return CheckResult('Bundletool', True, None, True, jar_path)
             except Exception:
                 pass
         
         # If we get here, either the wrapper doesn't exist or the JAR wasn't found
-        self.print_result('Bundletool', False)
+        return CheckResult('Bundletool', False)
 
     def run_all_checks(self):
         """Run all dependency checks."""
         print("Checking dependencies...")
         print("-" * 50)
         
-        self.check_python()
-        self.check_git()
-        self.check_docker()
-        self.check_adb()
-        self.check_bundletool()
+        checks = [
+            self.check_python,
+            self.check_git,
+            self.check_docker,
+            self.check_adb,
+            self.check_bundletool,
+        ]
+        # The probes are independent subprocess calls, so run them concurrently
+        # and print the results in a fixed order once they are all done.
+        with ThreadPoolExecutor() as executor:
+            futures = [executor.submit(check) for check in checks]
+            for future in futures:
+                self.print_result(*future.result())
         
         print("-" * 50)
         if self.all_passed:
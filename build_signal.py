@@ -1,10 +1,252 @@
 #!/usr/bin/env python3
+import ast
+import errno
+import functools
+import hashlib
+import io
+import json
+import mmap
 import os
+import re
 import subprocess
 import sys
 import shutil
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+SPLIT_CONFIG_RE = re.compile(r'split_config\.(.+)\.apk$')
+# Copying an initialised hash object is cheaper than setting up a new one,
+# which adds up when hashing every entry of every APK
+_SHA256_TEMPLATE = hashlib.sha256()
+
+@functools.lru_cache(maxsize=None)
+def probe(cmd):
+    """Run a short query command once per process and remember its result.
+    
+    cmd is a tuple so it can be used as the cache key.
+    """
+    return subprocess.run(list(cmd), capture_output=True, text=True, timeout=10)
+
+def version_tag(version):
+    """Return the git tag for a Signal version, e.g. 7.7.0 -> v7.7.0."""
+    return version if version.startswith('v') else f'v{version}'
+
+def dockerfile_instructions(path):
+    """Yield (instruction, arguments) for each instruction in a Dockerfile,
+    with line continuations joined and comments left out."""
+    joined = []
+    instruction = ''
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            # Docker drops comment and blank lines, even inside a continuation
+            if not line or line.startswith('#'):
+                continue
+            if line.endswith('\\'):
+                instruction += line[:-1] + ' '
+                continue
+            joined.append(instruction + line)
+            instruction = ''
+    if instruction.strip():
+        joined.append(instruction)
+    
+    for line in joined:
+        parts = line.split(None, 1)
+        yield parts[0].upper(), parts[1] if len(parts) > 1 else ''
+
+def copy_sources(arguments):
+    """Return the build context sources of a COPY or ADD instruction.
+    
+    Copies from another stage or image (--from) don't read the build context
+    and give no sources. Both the shell form and the JSON form are handled.
+    """
+    flags = []
+    while arguments.startswith('--'):
+        flag, *rest = arguments.split(None, 1)
+        flags.append(flag)
+        arguments = rest[0] if rest else ''
+    if any(flag.startswith('--from') for flag in flags):
+        return []
+    
+    args = None
+    if arguments.startswith('['):
+        try:
+            args = json.loads(arguments)
+        except ValueError:
+            pass
+    if not isinstance(args, list):
+        args = arguments.split()
+    return [str(arg) for arg in args[:-1]]
+
+def stage_done(marker, tag):
+    """Return whether a stage's marker file says it finished for this tag."""
+    try:
+        return marker.read_text() == tag
+    except OSError:
+        return False
+
+def clear_marker(marker):
+    """Remove a stage's marker before the stage starts over."""
+    try:
+        os.remove(marker)
+    except FileNotFoundError:
+        pass
+
+def sha256_file(path):
+    """Return the hex SHA-256 digest of a file."""
+    # Unbuffered, since both paths below read large blocks themselves
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, _SHA256_TEMPLATE.copy).hexdigest()
+        # Before Python 3.11, hash a memory map of the file so the data is
+        # handed to hashlib straight from the page cache. Empty files can't
+        # be mapped.
+        h = _SHA256_TEMPLATE.copy()
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+        return h.hexdigest()
+
+def copy_file(src, dst):
+    """Copy a large file and its metadata, keeping the data in the kernel.
+    
+    copy_file_range lets the filesystem clone or copy the data without it
+    passing through our process; if it isn't available or supported here,
+    fall back to shutil, which uses sendfile where it can.
+    """
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            remaining = os.fstat(s.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        if remaining > 0:
+            raise OSError(errno.EIO, 'short copy')
+    except (AttributeError, OSError):
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+def scan_apks(directory):
+    """Return the APK entries in a directory, sorted by name."""
+    entries = [e for e in os.scandir(directory) if e.name.endswith('.apk')]
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+def cached_sha256(path, hashes_dir, force=False):
+    """Return the SHA-256 of a file, reusing the digest stored by an earlier
+    run as long as the file's size and modification time are unchanged.
+    
+    With force, the file is always hashed again and the stored digest
+    replaced.
+    """
+    st = os.stat(path)
+    stamp = f'{st.st_mtime_ns} {st.st_size}'
+    path_key = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+    cache_file = hashes_dir / f'{path_key}.sha256'
+    
+    if not force:
+        try:
+            with open(cache_file, 'r') as f:
+                cached_stamp, digest = f.read().rsplit(' ', 1)
+            if cached_stamp == stamp:
+                return digest
+        except (OSError, ValueError):
+            pass
+    
+    digest = sha256_file(path)
+    os.makedirs(hashes_dir, exist_ok=True)
+    with open(cache_file, 'w') as f:
+        f.write(f'{stamp} {digest}')
+    return digest
+
+def apkdiff_ignore_files(apkdiff_path):
+    """Return the entries apkdiff leaves out of its comparison, or None.
+    
+    The IGNORE_FILES list is read from apkdiff's source rather than run, so
+    our own comparison ignores exactly what this version of apkdiff does.
+    None means the list couldn't be found and apkdiff should always run.
+    """
+    try:
+        with open(apkdiff_path, 'r') as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError, ValueError):
+        return None
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Assign) and
+                any(isinstance(t, ast.Name) and t.id == 'IGNORE_FILES'
+                    for t in node.targets)):
+            try:
+                return frozenset(ast.literal_eval(node.value))
+            except (ValueError, TypeError):
+                return None
+    return None
+
+def apk_entries(path, ignore_files):
+    """Return the sorted (entry name, SHA-256 digest) pairs of an APK,
+    leaving out the signing metadata in ignore_files.
+    
+    Two APKs with equal entries contain the same files with the same
+    contents, whatever they were signed with. Every entry is listed, so an
+    APK with duplicate names doesn't match one without.
+    """
+    entries = []
+    with zipfile.ZipFile(path) as z:
+        for info in z.infolist():
+            if info.filename in ignore_files:
+                continue
+            h = _SHA256_TEMPLATE.copy()
+            h.update(z.read(info))
+            entries.append((info.filename, h.digest()))
+    entries.sort()
+    return entries
+
+def diff_apks(pair):
+    """Run apkdiff on a (apkdiff, apkdiff digest, apkdiff ignore files,
+    built APK, device APK, hashes dir, force) tuple.
+    
+    Returns the APK name, the apkdiff exit code and its combined output.
+    apkdiff is not run at all if the files are identical, if they only
+    differ in their signatures, or if this same apkdiff has already reported
+    a match for these exact file contents. With force, digests and matches
+    stored by earlier runs are ignored.
+    """
+    (apkdiff_path, apkdiff_digest, ignore_files,
+     built_apk, device_apk, hashes_dir, force) = pair
+    built_digest = cached_sha256(built_apk, hashes_dir, force)
+    device_digest = cached_sha256(device_apk, hashes_dir, force)
+    if built_digest == device_digest:
+        return built_apk.name, 0, "Files are byte-for-byte identical"
+    
+    try:
+        if (ignore_files is not None and
+                apk_entries(built_apk, ignore_files) == apk_entries(device_apk, ignore_files)):
+            return built_apk.name, 0, "Files match apart from their signatures"
+    except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError):
+        # Leave unreadable APKs to apkdiff, which reports them itself
+        pass
+    
+    match_file = hashes_dir / f'{apkdiff_digest}-{built_digest}-{device_digest}.match'
+    if not force and match_file.exists():
+        return built_apk.name, 0, "apkdiff already reported a match for these files"
+    
+    # Run it with our own interpreter rather than via its shebang, which
+    # would need another PATH lookup for python3
+    cmd = [sys.executable, str(apkdiff_path), str(built_apk), str(device_apk)]
+    result = subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True
+    )
+    if result.returncode == 0:
+        match_file.touch()
+    return built_apk.name, result.returncode, f"$ {' '.join(cmd)}\n{result.stdout}"
+
 class SignalBuilder:
     def __init__(self):
         self.script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
@@ -12,51 +254,57 @@ class SignalBuilder:
         self.device_apks_dir = self.signal_dir / 'apks-from-device'
         self.built_apks_dir = self.signal_dir / 'apks-i-built'
         self.repo_dir = self.script_dir / 'Signal-Android'
+        self.cache_dir = Path.home() / '.cache' / 'reproducible-signal'
+        self.device_failed = threading.Event()
+        self.device_output = io.StringIO()
 
-    def run_command(self, cmd, cwd=None, check=True):
-        """Run a command and stream output in real-time."""
+    def run_command(self, cmd, cwd=None, check=True, env=None, out=None):
+        """Run a command, letting it write straight to our stdout.
+        
+        If out is given, the command's output and our messages are written
+        to it instead once the command has finished.
+        """
         try:
             # Print the command being run
-            print(f"\n$ {' '.join(cmd)}")
-            
-            process = subprocess.Popen(
-                cmd,
-                cwd=str(cwd) if cwd else None,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,  # Merge stderr into stdout
-                text=True,
-                bufsize=1,  # Line buffered
-                universal_newlines=True
-            )
-            
-            # Stream output in real-time
-            output = []
-            while True:
-                line = process.stdout.readline()
-                if not line and process.poll() is not None:
-                    break
-                if line:
-                    print(line.rstrip())
-                    output.append(line)
+            print(f"\n$ {' '.join(cmd)}", file=out)
             
-            # Get the return code
-            return_code = process.wait()
+            if out is None:
+                sys.stdout.flush()
+                process = subprocess.Popen(cmd, cwd=str(cwd) if cwd else None, env=env)
+                
+                # Get the return code
+                return_code = process.wait()
+            else:
+                result = subprocess.run(
+                    cmd,
+                    cwd=str(cwd) if cwd else None,
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    text=True
+                )
+                out.write(result.stdout)
+                return_code = result.returncode
             
             if check and return_code != 0:
-                print(f"\nCommand failed with exit code {return_code}")
+                print(f"\nCommand failed with exit code {return_code}", file=out)
                 sys.exit(return_code)
             
-            return subprocess.CompletedProcess(
-                cmd, return_code, 
-                stdout=''.join(output),
-                stderr=''
-            )
+            return subprocess.CompletedProcess(cmd, return_code)
             
         except Exception as e:
-            print(f"\nError running command: {' '.join(cmd)}")
-            print(f"Error: {str(e)}")
+            print(f"\nError running command: {' '.join(cmd)}", file=out)
+            print(f"Error: {str(e)}", file=out)
             sys.exit(1)
 
+    def run_capture(self, cmd, out=None):
+        """Run a short query command and return its output in one go.
+        
+        For commands whose small output we parse rather than show.
+        """
+        print(f"\n$ {' '.join(cmd)}", file=out)
+        return probe(tuple(cmd))
+
     def setup_directories(self):
         """Create necessary directories."""
         print("Setting up directories...")
@@ -65,27 +313,107 @@ class SignalBuilder:
 
     def clone_signal(self, version):
         """Clone Signal repository at specific version."""
-        if not version.startswith('v'):
-            version = f'v{version}'
+        version = version_tag(version)
         
         print(f"Cloning Signal Android repository version {version}...")
         if self.repo_dir.exists():
             shutil.rmtree(self.repo_dir)
         
+        # Partial clone of just the requested tag; blobs are fetched on checkout.
         self.run_command([
             'git', 'clone', '--depth', '1',
+            '--single-branch',
             '--branch', version,
+            '--filter=blob:none',
             'https://github.com/signalapp/Signal-Android.git'
         ])
 
+    def docker_image_key(self):
+        """Hash the Dockerfile and any local files it copies into the image.
+        
+        Returns None if a source can't be resolved to files in the build
+        context, since we then can't tell whether the image is up to date.
+        """
+        context_dir = self.repo_dir / 'reproducible-builds'
+        dockerfile = context_dir / 'Dockerfile'
+        key = hashlib.sha256(sha256_file(dockerfile).encode())
+        
+        sources = []
+        for instruction, arguments in dockerfile_instructions(dockerfile):
+            if instruction in ('COPY', 'ADD'):
+                sources.extend(copy_sources(arguments))
+        
+        for source in sorted(sources):
+            if source.startswith('<<'):
+                # A heredoc, whose contents are part of the Dockerfile itself
+                continue
+            # Only files inside the build context can be hashed; anything else
+            # (URLs, absolute paths, .. components) is left to docker build
+            if ('://' in source or source.startswith('git@') or
+                    os.path.isabs(source) or '..' in Path(source).parts):
+                return None
+            pattern = os.path.normpath(source)
+            # Expand wildcards such as *.sh the way COPY does
+            paths = [context_dir] if pattern == '.' else sorted(context_dir.glob(pattern))
+            if not paths:
+                return None
+            files = []
+            for path in paths:
+                if path.is_file():
+                    files.append(path)
+                elif path.is_dir():
+                    files.extend(sorted(p for p in path.rglob('*') if p.is_file()))
+            for file in files:
+                key.update(str(file.relative_to(context_dir)).encode())
+                key.update(sha256_file(file).encode())
+        return key.hexdigest()
+
     def build_docker_image(self):
         """Build the Signal Android Docker image."""
         print("Building Docker image...")
+        key = self.docker_image_key()
+        tags = ['-t', 'signal-android']
+        
+        if key is None:
+            print("Can't tell which files the Dockerfile copies, building the image")
+        else:
+            # An image built from identical inputs already exists; just point
+            # the plain tag at it instead of asking the daemon to rebuild
+            tagged_image = f'signal-android:{key}'
+            inspect = subprocess.run(
+                ['docker', 'image', 'inspect', tagged_image],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+            if inspect.returncode == 0:
+                print(f"Docker image {tagged_image} is up to date")
+                self.run_command(['docker', 'tag', tagged_image, 'signal-android'])
+                return
+            tags = ['-t', tagged_image, *tags]
+        
+        # Reuse the layers of the previous signal-android image. With
+        # BuildKit, also embed cache metadata in the image; it is only asked
+        # for when the buildx plugin is installed, since docker build fails
+        # outright without it, whereas the legacy builder still works.
+        build_cmd = ['docker', 'build', '--cache-from', 'signal-android']
+        env = None
+        if self.has_buildx():
+            build_cmd += ['--build-arg', 'BUILDKIT_INLINE_CACHE=1']
+            env = {**os.environ, 'DOCKER_BUILDKIT': '1'}
         self.run_command(
-            ['docker', 'build', '-t', 'signal-android', '.'],
-            cwd=self.repo_dir / 'reproducible-builds'
+            [*build_cmd, *tags, '.'],
+            cwd=self.repo_dir / 'reproducible-builds',
+            env=env
         )
 
+    def has_buildx(self):
+        """Return whether the docker buildx plugin, needed by BuildKit, is
+        installed."""
+        try:
+            return probe(('docker', 'buildx', 'version')).returncode == 0
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+
     def build_signal(self):
         """Build Signal using Docker."""
         print("Building Signal...")
@@ -102,17 +430,51 @@ class SignalBuilder:
         ])
 
     def copy_bundle(self):
-        """Copy the built bundle to our directory."""
+        """Move the built bundle to our directory."""
         bundle_path = self.repo_dir / 'app/build/outputs/bundle/playProdRelease/Signal-Android-play-prod-release.aab'
         target_path = self.built_apks_dir / 'bundle.aab'
         
         print("Copying bundle file...")
-        shutil.copy2(bundle_path, target_path)
+        # A rename is free on the same filesystem; only copy across devices
+        try:
+            os.replace(bundle_path, target_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            copy_file(bundle_path, target_path)
 
-    def check_adb_devices(self):
+    def bundle_cache_path(self, version):
+        """Return the cache location for the bundle built from this checkout.
+        
+        The key covers the Signal version and the files that define the build
+        environment, so any change to them results in a fresh build.
+        """
+        key = hashlib.sha256(version_tag(version).encode())
+        for name in ['reproducible-builds/Dockerfile',
+                     'gradle/wrapper/gradle-wrapper.properties']:
+            path = self.repo_dir / name
+            if path.exists():
+                key.update(sha256_file(path).encode())
+        return self.cache_dir / 'bundles' / f'{key.hexdigest()}.aab'
+
+    def restore_cached_bundle(self, cache_path, force=False):
+        """Copy a previously built bundle into place, if we have one and
+        force is not set."""
+        if force or not cache_path.exists():
+            return False
+        print(f"Using cached bundle: {cache_path}")
+        copy_file(cache_path, self.built_apks_dir / 'bundle.aab')
+        return True
+
+    def store_cached_bundle(self, cache_path):
+        """Save the freshly built bundle so later runs can skip the build."""
+        os.makedirs(cache_path.parent, exist_ok=True)
+        copy_file(self.built_apks_dir / 'bundle.aab', cache_path)
+
+    def check_adb_devices(self, out=None):
         """Check if any ADB devices are connected."""
-        print("Checking for connected Android devices...")
-        result = self.run_command(['adb', 'devices'], check=False)
+        print("Checking for connected Android devices...", file=out)
+        result = self.run_capture(['adb', 'devices'], out)
         
         # Parse the output to count connected devices
         lines = result.stdout.strip().split('\n')
@@ -120,12 +482,57 @@ class SignalBuilder:
         device_lines = [line for line in lines[1:] if line.strip()]
         
         if not device_lines:
-            print("Error: No Android devices connected. Please connect a device and try again.")
+            print("Error: No Android devices connected. Please connect a device and try again.",
+                  file=out)
             sys.exit(1)
             
-        print(f"Found {len(device_lines)} connected device(s):")
+        print(f"Found {len(device_lines)} connected device(s):", file=out)
         for line in device_lines:
-            print(f"  {line}")
+            print(f"  {line}", file=out)
+
+    def start_device_stage(self):
+        """Check for a device and pull its APKs while the build runs.
+        
+        The stage's output is collected in self.device_output and shown when
+        it is joined or found to have failed, so it doesn't interleave with
+        the build's. A failure only stops the build at those checkpoints.
+        """
+        out = self.device_output
+        def run():
+            try:
+                self.check_adb_devices(out)
+                self.pull_device_apks(out)
+            except SystemExit:
+                # The error has already been printed
+                self.device_failed.set()
+            except Exception as e:
+                print(f"Error while pulling APKs from device: {e}", file=out)
+                self.device_failed.set()
+        
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def show_device_output(self):
+        """Print the output the finished device stage has collected."""
+        output = self.device_output.getvalue()
+        self.device_output.seek(0)
+        self.device_output.truncate()
+        if output:
+            print(output, end='')
+
+    def join_device_stage(self, thread):
+        """Wait for the background device stage and show its output."""
+        thread.join()
+        self.show_device_output()
+        self.check_device_stage()
+
+    def check_device_stage(self):
+        """Stop early if the background device stage has failed."""
+        if self.device_failed.is_set():
+            self.show_device_output()
+            print("Error: Could not get APKs from device, stopping the build.")
+            sys.exit(1)
 
     def generate_apks(self):
         """Generate device-specific APKs using bundletool."""
@@ -149,59 +556,72 @@ class SignalBuilder:
         print("Cleaning up...")
         apks_dir = self.built_apks_dir / 'apks'
         if apks_dir.exists():
-            # Move APK files to parent directory
-            splits_dir = apks_dir / 'splits'
-            if splits_dir.exists():
-                for apk in splits_dir.glob('*.apk'):
-                    shutil.move(str(apk), str(self.built_apks_dir / apk.name))
-            
-            # Remove the apks directory
-            shutil.rmtree(apks_dir)
+            # Move APK files from splits/ to the parent directory and remove
+            # everything else, all in a single bottom-up pass over the tree
+            splits_dir = str(apks_dir / 'splits')
+            for root, dirs, files in os.walk(apks_dir, topdown=False):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if root == splits_dir and name.endswith('.apk'):
+                        os.replace(path, self.built_apks_dir / name)
+                    else:
+                        os.remove(path)
+                for name in dirs:
+                    os.rmdir(os.path.join(root, name))
+            os.rmdir(apks_dir)
         
         # Remove the bundle file
         bundle_file = self.built_apks_dir / 'bundle.aab'
         if bundle_file.exists():
             os.remove(bundle_file)
 
-    def pull_device_apks(self):
+    def pull_device_apks(self, out=None):
         """Pull Signal APKs from the connected device."""
-        print("\nPulling APKs from device...")
+        print("\nPulling APKs from device...", file=out)
         
         # Get paths of all Signal APKs on device
-        result = self.run_command(
-            ['adb', 'shell', 'pm', 'path', 'org.thoughtcrime.securesms'],
-            check=False
-        )
+        result = self.run_capture(['adb', 'shell', 'pm', 'path', 'org.thoughtcrime.securesms'], out)
         
         if not result.stdout.strip():
-            print("Error: Signal not found on device. Please make sure Signal is installed.")
+            print("Error: Signal not found on device. Please make sure Signal is installed.",
+                  file=out)
             sys.exit(1)
         
         # Extract paths and pull each APK
-        paths = [line.replace('package:', '').strip() 
-                for line in result.stdout.splitlines() 
-                if line.strip()]
+        paths = [line[len('package:'):].strip()
+                 for line in result.stdout.splitlines()
+                 if line.startswith('package:')]
         
-        print(f"Found {len(paths)} APK(s) on device:")
+        print(f"Found {len(paths)} APK(s) on device:", file=out)
+        renames = []
         for path in paths:
             # Extract the APK name from the path
             apk_name = os.path.basename(path)
-            if 'split_config.' in apk_name:
-                # Convert split_config.arm64-v8a.apk to base-arm64-v8a.apk format
-                config_type = apk_name.replace('split_config.', '')
-                target_name = f'base-{config_type}'
-            else:
-                # Convert base.apk to base-master.apk
-                target_name = 'base-master.apk'
-            
-            target_path = self.device_apks_dir / target_name
-            print(f"  Pulling {apk_name} -> {target_name}")
+            # Convert split_config.arm64-v8a.apk to base-arm64-v8a.apk format,
+            # and base.apk to base-master.apk
+            split_match = SPLIT_CONFIG_RE.match(apk_name)
+            config_type = split_match.group(1) if split_match else 'master'
+            target_name = f'base-{config_type}.apk'
             
-            self.run_command([
-                'adb', 'pull',
-                path,
-                str(target_path)
-            ])
+            print(f"  Pulling {apk_name} -> {target_name}", file=out)
+            renames.append((apk_name, self.device_apks_dir / target_name))
+        
+        # Pull everything in a single adb invocation into a staging directory,
+        # then rename the files to our naming convention
+        staging_dir = self.device_apks_dir / '.pulling'
+        if staging_dir.exists():
+            shutil.rmtree(staging_dir)
+        os.makedirs(staging_dir)
+        
+        self.run_command(['adb', 'pull', *paths, str(staging_dir)], out=out)
+        # Drop APKs an earlier pull left behind that the device no longer has
+        pulled = {target_path.name for _, target_path in renames}
+        for entry in scan_apks(self.device_apks_dir):
+            if entry.name not in pulled:
+                os.remove(entry.path)
+        for apk_name, target_path in renames:
+            os.replace(staging_dir / apk_name, target_path)
+        os.rmdir(staging_dir)
 
     def print_apk_summary(self):
         """Print a summary of the APKs in both directories."""
@@ -209,14 +629,12 @@ class SignalBuilder:
         print("-" * 50)
         
         print("\nAPKs from device:")
-        for apk in sorted(self.device_apks_dir.glob('*.apk')):
-            size = os.path.getsize(apk)
-            print(f"  {apk.name} ({size:,} bytes)")
+        for entry in scan_apks(self.device_apks_dir):
+            print(f"  {entry.name} ({entry.stat().st_size:,} bytes)")
             
         print("\nBuilt APKs:")
-        for apk in sorted(self.built_apks_dir.glob('*.apk')):
-            size = os.path.getsize(apk)
-            print(f"  {apk.name} ({size:,} bytes)")
+        for entry in scan_apks(self.built_apks_dir):
+            print(f"  {entry.name} ({entry.stat().st_size:,} bytes)")
 
     def setup_apkdiff(self):
         """Copy apkdiff.py from Signal repo and make it executable."""
@@ -233,13 +651,13 @@ class SignalBuilder:
         os.chmod(apkdiff_dest, 0o755)
         return apkdiff_dest
 
-    def compare_apks(self):
+    def compare_apks(self, force=False):
         """Compare APKs using apkdiff.py."""
         print("\nComparing APKs...")
         
         # First check if we have matching sets of APKs
-        built_apks = sorted(self.built_apks_dir.glob('*.apk'))
-        device_apks = sorted(self.device_apks_dir.glob('*.apk'))
+        built_apks = scan_apks(self.built_apks_dir)
+        device_apks = {entry.name: entry for entry in scan_apks(self.device_apks_dir)}
         
         if not built_apks or not device_apks:
             print("Error: No APKs found to compare.")
@@ -256,20 +674,31 @@ class SignalBuilder:
         print("-" * 50)
         all_match = True
         
-        # Compare APKs with matching names
+        # Compare APKs with matching names. Matches are recorded per apkdiff
+        # version, so a changed apkdiff looks at every pair again.
+        apkdiff_digest = sha256_file(apkdiff_path)
+        ignore_files = apkdiff_ignore_files(apkdiff_path)
+        pairs = []
         for built_apk in built_apks:
-            device_apk = self.device_apks_dir / built_apk.name
-            if not device_apk.exists():
+            device_apk = device_apks.get(built_apk.name)
+            if device_apk is None:
                 print(f"\nWarning: No matching device APK for {built_apk.name}")
                 all_match = False
                 continue
-                
-            print(f"\nComparing {built_apk.name}:")
-            result = self.run_command(
-                [str(apkdiff_path), str(built_apk), str(device_apk)],
-                check=False
-            )
-            if result.returncode != 0:
+            pairs.append((apkdiff_path, apkdiff_digest, ignore_files,
+                          Path(built_apk.path), Path(device_apk.path),
+                          self.cache_dir / 'hashes', force))
+        
+        # Unzipping and hashing the APKs is CPU-bound, so spread the pairs
+        # over worker processes and report in name order once they are done
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(diff_apks, pairs))
+        
+        for name, returncode, output in sorted(results):
+            print(f"\nComparing {name}:")
+            if output.strip():
+                print(output.rstrip())
+            if returncode != 0:
                 all_match = False
         
         if all_match:
@@ -280,20 +709,47 @@ class SignalBuilder:
             print("This could mean the installed version doesn't match the version you built,")
             print("or that the build wasn't fully reproducible.")
 
-    def build(self, version):
-        """Run the complete build process."""
+    def build(self, version, force=False):
+        """Run the complete build process.
+        
+        A build that already completed for this version is skipped unless
+        force is set, so the APKs can be compared again without rebuilding.
+        The APKs are pulled from the device on every run.
+        force also bypasses the bundle, digest and comparison caches.
+        """
         try:
             self.setup_directories()
-            self.clone_signal(version)
-            self.build_docker_image()
-            self.build_signal()
-            self.copy_bundle()
-            self.check_adb_devices()
-            self.generate_apks()
-            self.cleanup()
-            self.pull_device_apks()
+            tag = version_tag(version)
+            # The marker holds the tag the build last finished for, and is
+            # removed while the build runs, so an interrupted build or one for
+            # another version is never taken as done
+            built_marker = self.built_apks_dir / '.built'
+            
+            # The APKs are always pulled again, since what matters is what is
+            # on the device now rather than on an earlier run
+            device_stage = self.start_device_stage()
+            
+            if force or not stage_done(built_marker, tag):
+                clear_marker(built_marker)
+                self.clone_signal(version)
+                self.check_device_stage()
+                cache_path = self.bundle_cache_path(version)
+                if not self.restore_cached_bundle(cache_path, force):
+                    self.build_docker_image()
+                    self.check_device_stage()
+                    self.build_signal()
+                    self.copy_bundle()
+                    self.store_cached_bundle(cache_path)
+                self.join_device_stage(device_stage)
+                self.generate_apks()
+                self.cleanup()
+                built_marker.write_text(tag)
+            else:
+                print(f"APKs for {tag} were already built, skipping the build")
+            
+            self.join_device_stage(device_stage)
             self.print_apk_summary()
-            self.compare_apks()
+            self.compare_apks(force)
             
             print("\nBuild completed successfully!")
             print(f"APKs are located in:")
@@ -305,26 +761,32 @@ class SignalBuilder:
             sys.exit(1)
 
 def get_installed_version():
+    # Filter on the device, so only the versionName line is sent over adb
+    # rather than the whole package dump
     try:
-        result = subprocess.run(['adb', 'shell', 'dumpsys', 'package', 'org.thoughtcrime.securesms'], 
-                              capture_output=True, text=True, check=True)
-        for line in result.stdout.splitlines():
-            if 'versionName=' in line:
-                return line.split('=')[1].strip()
-    except subprocess.CalledProcessError:
+        result = probe(('adb', 'shell',
+                        'dumpsys package org.thoughtcrime.securesms | grep -m1 versionName='))
+    except (OSError, subprocess.TimeoutExpired):
         return None
+    if result.returncode != 0 or '=' not in result.stdout:
+        return None
+    return result.stdout.split('=', 1)[1].strip()
 
 def main():
-    version = sys.argv[1] if len(sys.argv) > 1 else get_installed_version()
+    args = sys.argv[1:]
+    force = '--force' in args
+    args = [arg for arg in args if arg != '--force']
+    
+    version = args[0] if args else get_installed_version()
     if not version:
         print("No version provided and couldn't detect installed version.")
         print("Example: ./build_signal.py 7.7.0")
         sys.exit(1)
-    if len(sys.argv) == 1:
+    if not args:
         print(f"Using installed Signal version: {version}")
     
     builder = SignalBuilder()
-    builder.build(version)
+    builder.build(version, force=force)
 
 if __name__ == "__main__":
     main()